@@ -7,30 +7,23 @@
 from __future__ import print_function
 
 
+## Note that other modules are imported only where needed, as startup
+## time matters when called on many small files.
 import re
 import sys
 import os.path
-import difflib
-import threading
+import time
 import locale
 
 
 from io import open
 
-try:
-    from Queue import Queue, Empty
-except ImportError:
-    from queue import Queue, Empty  # python 3.x
-
 
 PY3 = sys.version_info[0] >= 3
 WIN32 = sys.platform == 'win32'
 
 EXNAME = os.path.basename(__file__ if WIN32 else sys.argv[0])
 
-if WIN32:
-    import tempfile
-
 ## Note that locale.getpreferredencoding() does NOT follow
 ## PYTHONIOENCODING by default, but ``sys.stdout.encoding`` does. In
 ## PY2, ``sys.stdout.encoding`` without PYTHONIOENCODING set does not
@@ -40,7 +33,7 @@ _preferred_encoding = os.environ.get("PYTHONIOENCODING") or \
                       locale.getpreferredencoding()
 
 
-for ext in (".py", ".pyc", ".exe", "-script.py", "-script.pyc"):
+for ext in (".py", ".pyc", ".pyz", ".exe", "-script.py", "-script.pyc"):
     if EXNAME.endswith(ext):
         EXNAME = EXNAME[:-len(ext)]
         break
@@ -50,7 +43,13 @@ for ext in (".py", ".pyc", ".exe", "-script.py", "-script.pyc"):
 ## Python 2 and WIN32 bug correction
 ##
 
-if WIN32 and not PY3:  ## noqa: C901
+def win32_py2_popen():  ## noqa: C901
+    """Returns a ``Popen`` class supporting unicode command-line
+
+    This also patches ``_subprocess.CreateProcess``, and is meant to be
+    called only on windows with python 2.
+
+    """
 
     ## Sorry about the following, all this code is to ensure full
     ## compatibility with python 2.7 under windows about sending unicode
@@ -202,9 +201,7 @@ if WIN32 and not PY3:  ## noqa: C901
                 p2cwrite, c2pread, c2pwrite, errread, errwrite)
 
     _subprocess.CreateProcess = CreateProcess
-    from subprocess import PIPE
-else:
-    from subprocess import Popen, PIPE
+    return Popen
 
 
 class Phile(object):
@@ -286,24 +283,63 @@ class Phile(object):
         return self._file.close()
 
 
-class Proc(Popen):
+_proc_class = None
+
+
+def get_proc_class():
+    """Returns ``Proc`` class, created on first call
 
-    def __init__(self, command, env=None, encoding=_preferred_encoding):
-        super(Proc, self).__init__(
-            command, stdin=PIPE, stdout=PIPE, stderr=PIPE,
-            close_fds=ON_POSIX, env=env,
-            universal_newlines=False)
+    This avoids importing ``subprocess`` until a process is run.
 
-        self.stdin = Phile(self.stdin, encoding=encoding)
-        self.stdout = Phile(self.stdout, encoding=encoding)
-        self.stderr = Phile(self.stderr, encoding=encoding)
+    """
+    global _proc_class
+    if _proc_class is not None:
+        return _proc_class
+    if WIN32 and not PY3:
+        Popen = win32_py2_popen()
+    else:
+        from subprocess import Popen
+    from subprocess import PIPE, STDOUT
+
+    class Proc(Popen):
+        """Process with ``Phile`` pipes
+
+        With ``merge_streams``, standard error is redirected to standard
+        output, and there is no ``stderr`` pipe.
+
+        """
+
+        def __init__(self, command, env=None, cwd=None,
+                     encoding=_preferred_encoding, merge_streams=False):
+            super(Proc, self).__init__(
+                command, stdin=PIPE, stdout=PIPE,
+                stderr=STDOUT if merge_streams else PIPE,
+                close_fds=ON_POSIX, env=env, cwd=cwd,
+                universal_newlines=False)
+
+            self.stdin = Phile(self.stdin, encoding=encoding)
+            self.stdout = Phile(self.stdout, encoding=encoding)
+            if not merge_streams:
+                self.stderr = Phile(self.stderr, encoding=encoding)
+
+    _proc_class = Proc
+    return Proc
 
 
 USAGE = """\
 Usage:
 
     %(exname)s (-h|--help)
-    %(exname)s [[-r|--regex REGEX] ...] DOCSHTEST_FILE
+    %(exname)s [[-r|--regex REGEX] ...] [--show-rewrites]
+              [--syntax-cache FILE] [[-b|--block NUM] ...] [--merge-streams]
+              [--repeat N [--concurrency C]]
+              [--scratch MODE [--scratch-base DIR]
+              [--scratch-template DIR [--scratch-link]]]
+              [--connect SOCKET] DOCSHTEST_FILE
+    %(exname)s [[-r|--regex REGEX] ...] [--show-rewrites]
+              [--syntax-cache FILE] [--merge-streams]
+              --watch DOCSHTEST_FILE...
+    %(exname)s [--syntax-cache FILE] --serve SOCKET
 """ % {"exname": EXNAME}
 
 
@@ -321,6 +357,62 @@ Options:
               as many times as wanted. Regexps will be applied one by one
               in the same order than they are provided on the command line.
 
+    -b NUM, --block NUM
+              Only run the test block number NUM. You can select more
+              than one block by re-using this option.
+
+    --repeat N
+              Run each test N times, and report the number of failed
+              runs and the distribution of their durations.
+
+    --concurrency C
+              Use C concurrent workers to repeat tests (default: 1).
+
+    --scratch MODE
+              Run each test (MODE "block"), or all tests (MODE "file")
+              in a new scratch directory, removed in the background
+              afterwards.
+
+    --scratch-base DIR
+              Create scratch directories in DIR (default: /dev/shm if
+              available, or the temporary directory).
+
+    --scratch-template DIR
+              Populate scratch directories with copies of the content
+              of DIR.
+
+    --scratch-link
+              Populate scratch directories with hardlinks to files of
+              the template when possible, instead of copies. Tests
+              must then not modify these files in place.
+
+    --syntax-cache FILE
+              Load syntax checks results from FILE, and save them back
+              on exit. Results are kept only for the same version of
+              bash.
+
+    --show-rewrites
+              Print commands that were changed by regexes, before and
+              after their rewriting.
+
+    --merge-streams
+              Capture standard error of tests in the same pipe as
+              standard output. This ensures their content are mixed
+              in the order they were written.
+
+    --watch   Keep running, and check again given files each time they
+              change. Tests are run again from the first one that
+              changed or failed.
+
+    --serve SOCKET
+              Keep running, and serve requests sent with ``--connect``
+              on unix socket SOCKET. This avoids startup costs, and
+              keeps parsed files and syntax checks results in memory.
+
+    --connect SOCKET
+              Send the request to the server listening on unix socket
+              SOCKET instead of running the tests in this process.
+
 
 Examples:
 
@@ -341,6 +433,7 @@ cmd_line_quote = (lambda e: e.replace('\\', '\\\\')) if WIN32 else (lambda e: e)
 
 ## XXXvlab: code comes from kids.txt.diff
 def udiff(a, b, fa="", fb=""):
+    import difflib
     if not a.endswith("\n"):
         a += "\n"
     if not b.endswith("\n"):
@@ -369,38 +462,66 @@ def indent(text, prefix="  ", first=None):
                       for line in text.split('\n')])
 
 
+def enqueue_output(label, out, queue):
+    prev_line = None
+    for line in out.read():
+        if prev_line is not None:
+            queue.put((label, "%s\n" % prev_line))
+        prev_line = line
+        # print("%s: %r" % (label, line))
+    # print("END of %s" % (label, ))
+    if prev_line:
+        queue.put((label, prev_line))
+    out.close()
+
+
+def start_readers(proc, merge_streams=False):
+    """Read pipes of ``proc`` in threads, returns their queue and threads
+
+    With ``merge_streams``, only standard output is read.
+
+    """
+    import threading
+    try:
+        from Queue import Queue
+    except ImportError:
+        from queue import Queue  # python 3.x
+
+    q = Queue()
+    pipes = [("out", proc.stdout)]
+    if not merge_streams:
+        pipes.append(("err", proc.stderr))
+    threads = []
+    for label, f in pipes:
+        t = threading.Thread(target=enqueue_output, args=(label, f, q))
+        t.daemon = True  ## thread dies with the program
+        t.start()
+        threads.append(t)
+    return q, threads
+
+
 ## XXXvlab: consider for inclusion in ``kids.sh``
-def cmd_iter(cmd):
+def cmd_iter(cmd, cwd=None, merge_streams=False, environ=None):
     """Asynchrone subprocess driver
 
     returns an iterator that yields events of the life of the
     process.
 
+    With ``merge_streams``, standard error is read along standard
+    output from the same pipe, in the order it was written, and is
+    yielded as "out" events. ``environ`` is the environment of the
+    process, it defaults to the one of the current process.
+
     """
+    try:
+        from Queue import Empty
+    except ImportError:
+        from queue import Empty  # python 3.x
 
-    def thread_enqueue(label, f, q):
-        t = threading.Thread(target=enqueue_output, args=(label, f, q))
-        t.daemon = True  ## thread dies with the program
-        t.start()
-        return t
-
-    def enqueue_output(label, out, queue):
-        prev_line = None
-        for line in out.read():
-            if prev_line is not None:
-                queue.put((label, "%s\n" % prev_line))
-            prev_line = line
-            # print("%s: %r" % (label, line))
-        # print("END of %s" % (label, ))
-        if prev_line:
-            queue.put((label, prev_line))
-        out.close()
-
-    proc = Proc(cmd)
+    proc = get_proc_class()(cmd, env=environ, cwd=cwd,
+                            merge_streams=merge_streams)
     proc.stdin.close()
-    q = Queue()
-    t1 = thread_enqueue("out", proc.stdout, q)
-    t2 = thread_enqueue("err", proc.stderr, q)
+    q, threads = start_readers(proc, merge_streams)
     running = True
     while True:
         try:
@@ -410,7 +531,7 @@ def cmd_iter(cmd):
                 break
             proc.poll()
             running = proc.returncode is None or \
-                      any(t.is_alive() for t in (t1, t2))
+                      any(t.is_alive() for t in threads)
 
     # print("%s: %r" % ("errlvl", proc.returncode))
     yield "errorlevel", proc.returncode
@@ -563,7 +684,8 @@ def get_docshtest_blocks_org(lines):
         yield block[:-consecutive_empty] if consecutive_empty else block
 
 
-def bash_iter(cmd, syntax_check=False):
+def bash_iter(cmd, syntax_check=False, cwd=None, merge_streams=False,
+              environ=None):
     cmd_seq = ["bash", ]
     if syntax_check:
         cmd_seq.append("-n")
@@ -573,21 +695,162 @@ def bash_iter(cmd, syntax_check=False):
         ## as :
         ##   bash -c "echo é"   ## bash: $'echo \303\251': command not found
         ##   bash -c "echo ok"  ## ok
+        import tempfile
         with tempfile.TemporaryFile() as tf:
             tf.write(cmd.encode("utf-8"))
             tf.flush()
             cmd_seq.append(tf.name)
-            for ev, value in cmd_iter(cmd_seq):
+            for ev, value in cmd_iter(cmd_seq, cwd=cwd,
+                                      merge_streams=merge_streams,
+                                      environ=environ):
                 yield ev, value
     else:
         cmd_seq.extend(["-c", cmd])
-        for ev, value in cmd_iter(cmd_seq):
+        for ev, value in cmd_iter(cmd_seq, cwd=cwd,
+                                  merge_streams=merge_streams,
+                                  environ=environ):
             yield ev, value
 
 
+SYNTAX_CACHE_SIZE = 4096
+
+
+def get_bash_version():
+    output = ""
+    for ev, value in bash_iter('echo "$BASH_VERSION"'):
+        if ev == "out":
+            output += value
+    return output.strip()
+
+
+class SyntaxCache(object):
+    r"""LRU cache of syntax check verdicts of commands
+
+    Least recently used entries are dropped beyond ``maxsize``.
+
+        >>> cache = SyntaxCache(maxsize=2)
+        >>> cache.set("a", True); cache.set("b", False)
+        >>> cache.get("a"), cache.get("c")
+        (True, None)
+        >>> cache.set("c", True)
+        >>> sorted(cache.verdicts)
+        ['a', 'c']
+
+    Verdicts can be saved to a file, along with the version of
+    ``bash`` that gave them, and loaded back only with the same
+    version of ``bash``. Files that can't be read or don't have the
+    expected content are ignored.
+
+    """
+
+    def __init__(self, maxsize=SYNTAX_CACHE_SIZE):
+        import threading
+        from collections import OrderedDict
+        self.maxsize = maxsize
+        self.verdicts = OrderedDict()
+        self.changed = False
+        self.bash_version = None
+        self._lock = threading.Lock()
+
+    def get(self, command):
+        with self._lock:
+            verdict = self.verdicts.pop(command, None)
+            if verdict is not None:
+                self.verdicts[command] = verdict
+            return verdict
+
+    def set(self, command, verdict):
+        with self._lock:
+            self.verdicts.pop(command, None)
+            self.verdicts[command] = verdict
+            while len(self.verdicts) > self.maxsize:
+                self.verdicts.popitem(last=False)
+            self.changed = True
+
+    def load(self, path):
+        import json
+        ## also avoids running ``bash`` when saving, which can be done
+        ## at interpreter shutdown.
+        self.bash_version = get_bash_version()
+        try:
+            with open(path, "rb") as f:
+                data = json.loads(f.read().decode("utf-8"))
+        except (IOError, OSError, ValueError):
+            return
+        if not isinstance(data, dict):
+            return
+        if data.get("bash") != self.bash_version:
+            return
+        if not is_verdict_list(data.get("verdicts")):
+            return
+        for command, verdict in data["verdicts"]:
+            self.set(command, verdict)
+        self.changed = False
+
+    def save(self, path):
+        """Save verdicts to ``path``, if they changed since loaded"""
+        import json
+        if not self.changed:
+            return
+        if self.bash_version is None:
+            self.bash_version = get_bash_version()
+        with self._lock:
+            data = {"bash": self.bash_version,
+                    "verdicts": list(self.verdicts.items())}
+        tmp_path = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmp_path, "wb") as f:
+            f.write(json.dumps(data).encode("utf-8"))
+        if WIN32 and os.path.exists(path):
+            os.remove(path)
+        os.rename(tmp_path, path)
+
+
+def is_verdict_list(verdicts):
+    """Tells if ``verdicts`` is a list of ``[command, verdict]`` pairs
+
+        >>> is_verdict_list([[u"echo", True], [u"for", False]])
+        True
+        >>> is_verdict_list([[u"echo", "yes"]]), is_verdict_list({})
+        (False, False)
+
+    """
+    if not isinstance(verdicts, list):
+        return False
+    for item in verdicts:
+        if not (isinstance(item, list) and len(item) == 2):
+            return False
+        command, verdict = item
+        if not (isinstance(command, type(u"")) and isinstance(verdict, bool)):
+            return False
+    return True
+
+
+_syntax_cache = None
+
+
+def get_syntax_cache():
+    """Returns the syntax cache of the process, created on first call"""
+    global _syntax_cache
+    if _syntax_cache is None:
+        _syntax_cache = SyntaxCache()
+    return _syntax_cache
+
+
 def valid_syntax(command):
-    """Check if shell command if complete"""
+    """Check if shell command if complete
+
+    Verdicts are memoized in the syntax cache of the process.
+
+    """
+    cache = get_syntax_cache()
+    verdict = cache.get(command)
+    if verdict is None:
+        verdict = _valid_syntax(command)
+        cache.set(command, verdict)
+    return verdict
 
+
+def _valid_syntax(command):
     for ev, value in bash_iter(command, syntax_check=True):
         if ev == "err":
             if value.endswith("syntax error: unexpected end of file"):
@@ -611,42 +874,237 @@ class Ignored(Exception):
         self.args = args
 
 
-def run_and_check(command, expected_output):  ## noqa: C901
-    global __ENV__
+class InvalidExpectedOutput(Exception):
+
+    def __init__(self, *args):
+        self.args = args
+
+
+class OutputMatcher(object):
+    r"""Match output, fed by chunks, exactly against expected output
+
+    ``feed`` returns ``False`` as soon as output can't match anymore.
+    A missing final newline in output is accepted.
+
+        >>> m = OutputMatcher("foo\nbar\n")
+        >>> m.feed("foo\n"), m.feed("bar"), m.match()
+        (True, True, True)
+        >>> m = OutputMatcher("foo\nbar\n")
+        >>> m.feed("foo\n"), m.feed("baz\n"), m.match()
+        (True, False, False)
+
+    Matchers are created from the value returned by ``prepare``, which
+    is called once per test even if the test is run several times.
+
+    """
+
+    @staticmethod
+    def prepare(expected):
+        return expected
+
+    def __init__(self, expected):
+        self.remaining = expected
+        self.failed = False
+
+    def feed(self, chunk):
+        if not self.failed and self.remaining.startswith(chunk):
+            self.remaining = self.remaining[len(chunk):]
+        else:
+            self.failed = True
+        return not self.failed
+
+    def match(self):
+        return not self.failed and not len(chomp(self.remaining))
+
+
+class EllipsisMatcher(OutputMatcher):
+    r"""Match output against expected output where "..." matches anything
+
+    As "..." matches any text, including newlines, output fed so far
+    can only become impossible to match by diverging from the text
+    before the first "..." (or from the whole expected output if
+    there is none). It is rejected on its first diverging character.
+    Otherwise, it can only be checked once complete.
+
+        >>> m = EllipsisMatcher("pid: ...\nend\n")
+        >>> m.feed("pid: 1234\n"), m.feed("end\n"), m.match()
+        (True, True, True)
+        >>> m = EllipsisMatcher("pid: ...\nend\n")
+        >>> m.feed("PID: 1234\n"), m.match()
+        (False, False)
+        >>> m = EllipsisMatcher("a...b...b\n")
+        >>> m.feed("ab\n"), m.match()
+        (True, False)
+        >>> m = EllipsisMatcher("foo\n")
+        >>> m.feed("foo\n"), m.feed("bar\n")
+        (True, False)
+
+    """
+
+    def __init__(self, expected):
+        self.pieces = expected.split("...")
+        self.output = ""
+        self.failed = False
+
+    def feed(self, chunk):
+        start = len(self.output)
+        self.output += chunk
+        end = len(self.output)
+        if len(self.pieces) > 1:
+            end = min(end, len(self.pieces[0]))
+        if not self.failed and start < end:
+            self.failed = self.output[start:end] != self.pieces[0][start:end]
+        return not self.failed
+
+    def match(self):
+        if self.failed:
+            return False
+        return any(ellipsis_match(self.pieces, output)
+                   for output in (self.output, self.output + "\n"))
+
+
+def ellipsis_match(pieces, output):
+    """Tells if output matches pieces separated by ellipsis
+
+    Adapted from ``doctest._ellipsis_match``.
+
+    """
+    if len(pieces) == 1:
+        return pieces[0] == output
+    start, end = pieces[0], pieces[-1]
+    if not (output.startswith(start) and output.endswith(end)):
+        return False
+    start_pos, end_pos = len(start), len(output) - len(end)
+    if start_pos > end_pos:
+        return False
+    for piece in pieces[1:-1]:
+        start_pos = output.find(piece, start_pos, end_pos)
+        if start_pos < 0:
+            return False
+        start_pos += len(piece)
+    return True
+
+
+class RegexMatcher(OutputMatcher):
+    r"""Match whole output against expected output taken as a regex
+
+    Output can only be checked once complete. The regex is compiled
+    by ``prepare``:
+
+        >>> regex = RegexMatcher.prepare("pid: [0-9]+\n")
+        >>> m = RegexMatcher(regex)
+        >>> m.feed("pid: 1234\n"), m.match()
+        (True, True)
+        >>> m = RegexMatcher(regex)
+        >>> m.feed("pid: 1234\nfoo\n"), m.match()
+        (True, False)
+
+    """
+
+    @staticmethod
+    def prepare(expected):
+        try:
+            ## reports errors at their position in expected output
+            re.compile(expected)
+            return re.compile(r"(?:%s)\Z" % expected)
+        except re.error as e:
+            raise InvalidExpectedOutput("invalid regex-output: %s" % e)
+
+    def __init__(self, regex):
+        self.regex = regex
+        self.output = ""
+
+    def feed(self, chunk):
+        self.output += chunk
+        return True
+
+    def match(self):
+        return any(self.regex.match(output)
+                   for output in (self.output, self.output + "\n"))
+
+
+OUTPUT_MATCHERS = {
+    "ellipsis": EllipsisMatcher,
+    "regex-output": RegexMatcher,
+}
+
+
+def get_output_matcher(meta_commands):
+    """Returns matcher class selected by meta-commands"""
+    for meta_command in meta_commands:
+        if meta_command[0] in OUTPUT_MATCHERS:
+            return OUTPUT_MATCHERS[meta_command[0]]
+    return OutputMatcher
+
+
+class MatcherFactory(object):
+    """Create matchers of the expected output of a test
+
+    Expected output is prepared once, on the first created matcher,
+    so that it is not done for ignored tests.
+
+    """
+
+    def __init__(self, command, expected_output):
+        self.matcher_class = get_output_matcher(get_meta_commands(command))
+        self.expected = expected_output.replace("<BLANKLINE>\n", "\n")
+        self._prepared = None
+
+    def __call__(self):
+        if self._prepared is None:
+            self._prepared = self.matcher_class.prepare(self.expected)
+        return self.matcher_class(self._prepared)
+
+
+def run_and_check(command, expected_output, env=None,  ## noqa: C901
+                  shell_iter=bash_iter, cwd=None, merge_streams=False,
+                  environ=None, matcher_factory=None):
+    """Run command and compare its output to expected output
+
+    ``env`` holds the state of meta-commands, it defaults to the
+    module-wide ``__ENV__``. ``shell_iter`` is the subprocess driver,
+    and ``environ`` the environment given to it. ``matcher_factory``
+    can be given to share a ``MatcherFactory`` between runs.
+
+    """
+    if env is None:
+        env = __ENV__
+    if matcher_factory is None:
+        matcher_factory = MatcherFactory(command, expected_output)
     meta_commands = list(get_meta_commands(command))
     for meta_command in meta_commands:
         if meta_command[0] == "ignore-if":
-            if any(k in __ENV__ for k in meta_command[1].split(",")):
+            if any(k in env for k in meta_command[1].split(",")):
                 raise Ignored(*meta_command)
         if meta_command[0] == "ignore-if-not":
-            if meta_command[1] not in __ENV__:
+            if meta_command[1] not in env:
                 raise Ignored(*meta_command)
 
-    expected_output = expected_output.replace("<BLANKLINE>\n", "\n")
-    orig_expected_output = expected_output
+    expected_output = matcher_factory.expected
+    matcher = matcher_factory()
     output = ""
     diff = False
-    for ev, value in bash_iter(command):
+    for ev, value in shell_iter(command, cwd=cwd,
+                                merge_streams=merge_streams,
+                                environ=environ):
         if ev in ("err", "out"):
             if WIN32:
                 value = value.replace("\r\n", "\n")
             output += value
-            if not diff and expected_output.startswith(value):
-                expected_output = expected_output[len(value):]
-            else:
+            if not diff and not matcher.feed(value):
                 diff = True
-    if not diff and len(chomp(expected_output)):
+    if not diff and not matcher.match():
         diff = True
 
     for meta_command in meta_commands:
         if meta_command[0] == "if-success-set":
             if not diff:
-                __ENV__[meta_command[1]] = 1
+                env[meta_command[1]] = 1
                 raise Ignored(*meta_command)
             else:
                 raise Ignored(*meta_command)
     if diff:
-        raise UnmatchedLine(output, orig_expected_output)
+        raise UnmatchedLine(output, expected_output)
     return value == 0
 
 
@@ -665,21 +1123,62 @@ def format_failed_test(message, command, output, expected):
     return "%s\n%s" % (message, indent(formatted, prefix="  "))
 
 
-def apply_regex(patterns, s):
-    for p in patterns:
-        s = re.sub(p[0], p[1], s)
-    return s
+class Rewriter(object):
+    """Apply regex patterns one by one, in the given order
+
+    Patterns are compiled once, and results are memoized by text for
+    the lifetime of the rewriter, so ``get_tests`` uses a new one for
+    each parsed file.
+
+        >>> rewrite = Rewriter([("foo", "bar"), ("bar", "baz")])
+        >>> rewrite("foo bar")
+        'baz baz'
+
+    """
+
+    def __init__(self, patterns):
+        self.patterns = [(re.compile(p[0]), p[1]) for p in patterns]
+        self._cache = {}
+
+    def __call__(self, s):
+        if s not in self._cache:
+            result = s
+            for regex, replacement in self.patterns:
+                result = regex.sub(replacement, result)
+            self._cache[s] = result
+        return self._cache[s]
 
 
 META_COMMAND_REGEX = '##? docshtest: (?P<cmd>.*)$'
 
+## number of arguments of meta-commands, so that several of them can
+## follow each other on the same line.
+META_COMMAND_NB_ARGS = {
+    "ignore-if": 1,
+    "ignore-if-not": 1,
+    "if-success-set": 1,
+    "ellipsis": 0,
+    "regex-output": 0,
+}
+
 
 def get_meta_commands(command):
+    """Returns an iterator of meta-commands of command
+
+        >>> list(get_meta_commands("echo  ## docshtest: ellipsis "
+        ...                        "ignore-if-not A"))
+        [['ellipsis'], ['ignore-if-not', 'A']]
+
+    """
     for m in re.finditer(META_COMMAND_REGEX, command):
         raw_cmd = m.groupdict()["cmd"]
         cmd = raw_cmd.strip()
         cmd = re.sub(' +', ' ', cmd)
-        yield cmd.split(' ')
+        words = cmd.split(' ')
+        while words:
+            nb_args = META_COMMAND_NB_ARGS.get(words[0], len(words) - 1)
+            yield words[:nb_args + 1]
+            words = words[nb_args + 1:]
 
 
 def get_docshtest_blocks_for_file(filename, lines):
@@ -689,29 +1188,58 @@ def get_docshtest_blocks_for_file(filename, lines):
     return get_docshtest_blocks(lines)
 
 
-def shtest_runner(filename, lines, regex_patterns):
-    def _lines(start_line_nb, stop_line_nb):
-        return (("lines %9s" % ("%s-%s" % (start_line_nb, stop_line_nb)))
-                if start_line_nb != stop_line_nb else
-                ("line %10s" % start_line_nb))
+def format_line_range(start_line_nb, stop_line_nb):
+    return (("lines %9s" % ("%s-%s" % (start_line_nb, stop_line_nb)))
+            if start_line_nb != stop_line_nb else
+            ("line %10s" % start_line_nb))
 
+
+def get_command_end(block, rewrite):
+    r"""Returns index of the last line of the command of the block
+
+    The command ends on the first line where the command so far, once
+    rewritten, is valid. Returns ``None`` if command never ends.
+
+        >>> block = [(1, 'echo "a\n'), (2, 'b"\n')]
+        >>> get_command_end(block, Rewriter([]))
+        1
+        >>> get_command_end(block, Rewriter([('"', '#')]))
+        0
+
+    """
+    command = ""
+    for idx, (_line_nb, line) in enumerate(block):
+        command += line
+        if valid_syntax(rewrite(command)):
+            return idx
+    return None
+
+
+def get_tests(filename, lines, regex_patterns, on_rewrite=None):
+    """Returns an iterator of tests from the lines of a docshtest file
+
+    Each test is a tuple ``(block_nb, line_range, command,
+    expected_output)``. If given, ``on_rewrite`` is called with block
+    number, line range, and command before and after rewrite by
+    ``regex_patterns`` for each command changed by them.
+
+    """
+    rewrite = Rewriter(regex_patterns)
     for block_nb, block in enumerate(get_docshtest_blocks_for_file(filename, lines)):
-        lines = iter(block)
-        command_block = ""
-        start_line_nb = None
-        stop_line_nb = None
-        for line_nb, line in lines:
-            start_line_nb = start_line_nb or line_nb
-            command_block += line
-            if valid_syntax(apply_regex(regex_patterns,
-                                        command_block)):
-                stop_line_nb = line_nb
-                break
-        else:
+        end = get_command_end(block, rewrite)
+        if end is None:
             raise ValueError("Invalid Block:\n%s"
-                             % (indent(command_block, "   | ")))
+                             % (indent("".join(l for _, l in block),
+                                       "   | ")))
+        start_line_nb, stop_line_nb = block[0][0], block[end][0]
+        lines = iter(block[end + 1:])
+        command_block = "".join(l for _, l in block[:end + 1])
         command_block = command_block.rstrip("\n\r")
-        command_block = apply_regex(regex_patterns, command_block)
+        rewritten = rewrite(command_block)
+        if on_rewrite and rewritten != command_block:
+            on_rewrite(block_nb + 1, (start_line_nb, stop_line_nb),
+                       command_block, rewritten)
+        command_block = rewritten
         # For Org files, dedent expected output (strip common leading whitespace)
         # This allows indenting expected output to avoid $ being parsed as command
         if filename.endswith('.org'):
@@ -732,25 +1260,630 @@ def shtest_runner(filename, lines, regex_patterns):
         else:
             expected_output = "".join(
                 unescape_expected_line(line) for _, line in lines)
+        yield (block_nb + 1, (start_line_nb, stop_line_nb),
+               command_block, expected_output)
+
+
+##
+## Scratch directories
+##
+
+def get_scratch_base():
+    """Returns ``/dev/shm`` if usable, or the default temporary directory"""
+    import tempfile
+    if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK):
+        return "/dev/shm"
+    return tempfile.gettempdir()
+
+
+def copy_tree(src, dst, link=False):
+    """Populate ``dst`` with copies of files of ``src``
+
+    With ``link``, files are hardlinked instead, and copied only when
+    hardlinks are not possible (as between two file systems).
+
+    """
+    import errno
+    import shutil
+    for root, dirs, files in os.walk(src):
+        target = os.path.join(dst, os.path.relpath(root, src))
+        for name in dirs + files:
+            path = os.path.join(root, name)
+            if os.path.islink(path):
+                os.symlink(os.readlink(path), os.path.join(target, name))
+            elif name in dirs:
+                os.mkdir(os.path.join(target, name))
+            elif not link:
+                shutil.copy2(path, os.path.join(target, name))
+            else:
+                try:
+                    os.link(path, os.path.join(target, name))
+                except OSError as e:
+                    if e.errno not in (errno.EXDEV, errno.EPERM,
+                                       errno.EMLINK):
+                        raise
+                    shutil.copy2(path, os.path.join(target, name))
+
+
+def make_scratch_dir(base=None, template=None, link=False):
+    """Create a new scratch directory, populated from ``template``
+
+    The directory is removed if it can't be populated.
+
+    """
+    import tempfile
+    path = tempfile.mkdtemp(prefix="docshtest-",
+                            dir=base or get_scratch_base())
+    try:
+        if template:
+            copy_tree(template, path, link)
+    except Exception:
+        remove_scratch_dir(path)
+        raise
+    return path
+
+
+def remove_scratch_dir(path):
+    """Remove scratch directory in a background thread
+
+    The thread is not a daemon, so the process will wait for it
+    before exiting.
+
+    """
+    import shutil
+    import threading
+    t = threading.Thread(target=shutil.rmtree, args=(path, True))
+    t.start()
+    return t
+
+
+def is_failed_run(duration, e, env):
+    """Tells if a run of ``Session.run_once`` failed"""
+    if isinstance(e, (UnmatchedLine, InvalidExpectedOutput)):
+        return True
+    if not isinstance(e, Ignored):
+        return False
+    ## ``if-success-set`` is ignored even if the test failed
+    return e.args[0] == "if-success-set" and e.args[1] not in env
+
+
+def format_stats(durations, nb_failures):
+    """Format number of failures and latency distribution of runs
+
+        >>> print(format_stats([0.004, 0.001, 0.003, 0.002], 1))
+        4 runs, 1 failed (25.0%), min 1.0ms, median 2.5ms, p95 4.0ms, max 4.0ms
+
+    """
+    import math
+    durations = sorted(durations)
+    nb = len(durations)
+    median = (durations[nb // 2] + durations[(nb - 1) // 2]) / 2.0
+    p95 = durations[int(math.ceil(0.95 * nb)) - 1]
+    return ("%d runs, %d failed (%.1f%%), min %.1fms, median %.1fms, "
+            "p95 %.1fms, max %.1fms"
+            % (nb, nb_failures, 100.0 * nb_failures / nb,
+               durations[0] * 1000, median * 1000, p95 * 1000,
+               durations[-1] * 1000))
+
+
+class Session(object):
+    r"""Run tests with their own state
+
+    A session owns the state of meta-commands, the regex patterns, the
+    output stream and the subprocess driver (along with the
+    ``environ`` it gives to tests, defaulting to the one of the
+    process), so that several sessions can run concurrently in
+    separate threads of the same process.
+    With ``merge_streams``, standard error of tests is captured in the
+    same pipe as standard output. With ``repeat``, each test is run
+    several times over ``concurrency`` threads. With ``scratch`` set to
+    "block" (or "file"), each run of a test (or each run of tests) is
+    done in a new scratch directory created in ``scratch_base`` and
+    populated with copies (or hardlinks, with ``scratch_link``) of
+    files of ``scratch_template``.
+
+        >>> session = Session()
+        >>> session.run_block(1, (3, 3), "echo hello", "hello\n")
+        #0001 - success (line          3)
+        'success'
+
+    Meta-commands state is kept in the session::
+
+        >>> session.run_block(2, (5, 5), "true  ## docshtest: if-success-set A",
+        ...                   "")
+        #0002 - ignored (line          5): if-success-set A
+        'ignored'
+        >>> session.env
+        {'A': 1}
+
+    """
+
+    def __init__(self, regex_patterns=None, out=None, env=None,
+                 shell_iter=bash_iter, cwd=None, environ=None,
+                 merge_streams=False, show_rewrites=False, repeat=1,
+                 concurrency=1,
+                 scratch=None, scratch_base=None, scratch_template=None,
+                 scratch_link=False):
+        self.regex_patterns = regex_patterns or []
+        self.show_rewrites = show_rewrites
+        self.out = out
+        self.env = {} if env is None else env
+        self.shell_iter = shell_iter
+        self.environ = environ
+        self.cwd = cwd
+        self.merge_streams = merge_streams
+        self.repeat = repeat
+        self.concurrency = concurrency
+        self.scratch = scratch
+        self.scratch_base = scratch_base
+        self.scratch_template = scratch_template
+        self.scratch_link = scratch_link
+
+    def echo(self, content=""):
+        safe_print("%s\n" % content, out=self.out)
+
+    def show_rewrite(self, block_nb, line_range, command, rewritten):
+        formatted = "before:\n%s\nafter:\n%s" % (indent(command, "| "),
+                                                 indent(rewritten, "| "))
+        self.echo("#%04d - rewrite (%15s):\n%s"
+                  % (block_nb, format_line_range(*line_range),
+                     indent(formatted, prefix="  ")))
+
+    def get_tests(self, filename, lines):
+        return get_tests(filename, lines, self.regex_patterns,
+                         self.show_rewrite if self.show_rewrites else None)
+
+    def run_once(self, command_block, expected_output, env,
+                 matcher_factory=None):
+        """Run test once, returns its duration, exception and ``env``"""
+        cwd = self.cwd
         try:
-            run_and_check(command_block, expected_output)
-        except UnmatchedLine as e:
-            safe_print(format_failed_test(
+            if self.scratch == "block":
+                cwd = self.make_scratch_dir()
+            start = time.time()
+            try:
+                run_and_check(command_block, expected_output, env=env,
+                              shell_iter=self.shell_iter, cwd=cwd,
+                              merge_streams=self.merge_streams,
+                              environ=self.environ,
+                              matcher_factory=matcher_factory)
+            except (UnmatchedLine, Ignored, InvalidExpectedOutput) as e:
+                return time.time() - start, e, env
+            return time.time() - start, None, env
+        finally:
+            if cwd != self.cwd:
+                remove_scratch_dir(cwd)
+
+    def make_scratch_dir(self):
+        return make_scratch_dir(self.scratch_base, self.scratch_template,
+                                self.scratch_link)
+
+    def check(self, command_block, expected_output):
+        """Run test ``repeat`` times over ``concurrency`` threads
+
+        Each repeated run gets its own copy of the meta-commands state.
+        Returns the list of the results of ``run_once`` for each run.
+        Unexpected errors of runs stop remaining runs, and are raised
+        again in the calling thread:
+
+            >>> def broken_iter(command, **kwargs):
+            ...     raise OSError("no shell")
+            ...     yield
+            >>> Session(shell_iter=broken_iter, repeat=4,
+            ...         concurrency=2).check("true", "")
+            Traceback (most recent call last):
+            ...
+            OSError: no shell
+
+        """
+        matcher_factory = MatcherFactory(command_block, expected_output)
+        if self.repeat == 1:
+            return [self.run_once(command_block, expected_output, self.env,
+                                  matcher_factory)]
+        import threading
+        from collections import deque
+        runs = [None] * self.repeat
+        jobs = deque(range(self.repeat))
+        errors = []
+        args = (command_block, expected_output, matcher_factory, jobs,
+                runs, errors)
+        threads = [threading.Thread(target=self.check_worker, args=args)
+                   for _ in range(min(self.concurrency, self.repeat))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        if errors:
+            raise errors[0]
+        return runs
+
+    def check_worker(self, command_block, expected_output, matcher_factory,
+                     jobs, runs, errors):
+        """Run test once for each run index popped from ``jobs``"""
+        while True:
+            try:
+                idx = jobs.popleft()
+            except IndexError:
+                return
+            try:
+                runs[idx] = self.run_once(command_block, expected_output,
+                                          dict(self.env), matcher_factory)
+            except Exception as e:
+                errors.append(e)
+                jobs.clear()
+                return
+
+    def run_block(self, block_nb, line_range, command_block, expected_output):
+        """Run one test and print its report
+
+        Returns the status of the test: "success", "ignored" or "failure".
+        When repeated, the reported outcome is the one of the first
+        failing run if any, and is followed by latency statistics.
+
+        """
+        runs = self.check(command_block, expected_output)
+        failed_runs = [run for run in runs if is_failed_run(*run)]
+        _duration, e, env = failed_runs[0] if failed_runs else runs[0]
+        if not failed_runs:
+            self.env.update(env)
+        if isinstance(e, UnmatchedLine):
+            self.echo(format_failed_test(
                 "#%04d - failure (%15s):"
-                % (block_nb + 1, _lines(start_line_nb, stop_line_nb)),
+                % (block_nb, format_line_range(*line_range)),
                 command_block,
                 e.args[0],
                 e.args[1]))
-            exit(1)
-        except Ignored as e:
-            print("#%04d - ignored (%15s): %s"
-                  % (block_nb + 1,
-                     _lines(start_line_nb, stop_line_nb),
-                     " ".join(e.args)))
+            status = "failure"
+        elif isinstance(e, InvalidExpectedOutput):
+            self.echo("#%04d - failure (%15s): %s"
+                      % (block_nb, format_line_range(*line_range), e.args[0]))
+            status = "failure"
+        elif isinstance(e, Ignored):
+            self.echo("#%04d - ignored (%15s): %s"
+                      % (block_nb,
+                         format_line_range(*line_range),
+                         " ".join(e.args)))
+            status = "ignored"
         else:
-            print("#%04d - success (%15s)"
-                  % (block_nb + 1, _lines(start_line_nb, stop_line_nb)))
-        sys.stdout.flush()
+            self.echo("#%04d - success (%15s)"
+                      % (block_nb, format_line_range(*line_range)))
+            status = "success"
+        if self.repeat > 1:
+            self.echo("  %s" % format_stats([run[0] for run in runs],
+                                            len(failed_runs)))
+        return status
+
+    def run_tests(self, tests, blocks=None):
+        """Run tests, stopping at first failure
+
+        If ``blocks`` is given, only tests whose block number is in it
+        are run. Returns ``False`` if a test failed.
+
+        """
+        if self.scratch != "file":
+            return self._run_tests(tests, blocks)
+        cwd = self.cwd
+        self.cwd = self.make_scratch_dir()
+        try:
+            return self._run_tests(tests, blocks)
+        finally:
+            remove_scratch_dir(self.cwd)
+            self.cwd = cwd
+
+    def _run_tests(self, tests, blocks):
+        for test in tests:
+            if blocks and test[0] not in blocks:
+                continue
+            if self.run_block(*test) == "failure":
+                return False
+        return True
+
+    def run_file(self, filename, blocks=None):
+        with open(filename, encoding=_preferred_encoding) as f:
+            return self.run_tests(self.get_tests(filename, f), blocks)
+
+
+def shtest_runner(filename, lines, regex_patterns, blocks=None,
+                  **session_options):
+    session = Session(regex_patterns, env=__ENV__, **session_options)
+    if not session.run_tests(session.get_tests(filename, lines), blocks):
+        exit(1)
+
+
+##
+## Watch mode
+##
+
+WATCH_INTERVAL = 0.2
+
+
+def get_file_stamp(filename):
+    """Returns a value that changes each time the file is written
+
+    Nanoseconds modification time (when available) and change time
+    make same size writes detected even on file systems with coarse
+    timestamps, and the inode number catches files replaced by a
+    rename, as many editors do.
+
+    """
+    stat = os.stat(filename)
+    return (getattr(stat, "st_mtime_ns", stat.st_mtime), stat.st_ctime,
+            stat.st_size, stat.st_ino)
+
+
+def get_meta_vars(meta_commands):
+    """Returns variables set and variables used by given meta-commands
+
+        >>> get_meta_vars([["if-success-set", "A"],
+        ...                ["ignore-if", "B,C"]])
+        (['A'], ['B', 'C'])
+
+    """
+    set_vars, used_vars = [], []
+    for meta_command in meta_commands:
+        if meta_command[0] == "if-success-set":
+            set_vars.append(meta_command[1])
+        elif meta_command[0] in ("ignore-if", "ignore-if-not"):
+            used_vars.extend(meta_command[1].split(","))
+    return set_vars, used_vars
+
+
+def watch_run(filename, regex_patterns, previous, **session_options):
+    r"""Run tests of file that are not known to succeed from ``previous``
+
+    ``previous`` is the return value of the last call on the same
+    file. Results of tests are reused only for the leading tests of
+    the file whose command and expected output didn't change, and
+    that succeeded or were ignored last time. From the first test
+    that is run again, all following tests are run again, as they
+    could depend on its side effects.
+
+    Returns results that should be given as ``previous`` on next call.
+
+        >>> import tempfile
+        >>> tmp_dir = tempfile.mkdtemp()
+        >>> filename = os.path.join(tmp_dir, "doc.rst")
+        >>> def write(content):
+        ...     with open(filename, "w") as f:
+        ...         f.write(content)
+
+        >>> write(u"    $ echo hello > data\n"
+        ...       u"    $ cat data\n"
+        ...       u"    hello\n")
+        >>> results = watch_run(filename, [], [],
+        ...                     cwd=tmp_dir)  # doctest: +ELLIPSIS
+        #0001 - success (line          1)
+        #0002 - success (line          2)
+        -- .../doc.rst: 2 run, 0 unchanged
+
+    Only tests from the first changed one are run again::
+
+        >>> write(u"    $ echo hello > data\n"
+        ...       u"    $ cat data | cat\n"
+        ...       u"    hello\n")
+        >>> results = watch_run(filename, [], results,
+        ...                     cwd=tmp_dir)  # doctest: +ELLIPSIS
+        #0002 - success (line          2)
+        -- .../doc.rst: 1 run, 1 unchanged
+
+        >>> write(u"    $ echo bye > data\n"
+        ...       u"    $ cat data | cat\n"
+        ...       u"    hello\n")
+        >>> results = watch_run(filename, [], results,
+        ...                     cwd=tmp_dir)  # doctest: +ELLIPSIS
+        #0001 - success (line          1)
+        #0002 - failure (line          2):
+          command:
+          | cat data | cat
+          expected:
+          | hello
+          |
+          output:
+          | bye
+          |
+        -- .../doc.rst: 2 run, 0 unchanged
+
+    """
+    with open(filename, encoding=_preferred_encoding) as f:
+        lines = f.readlines()
+    session = Session(regex_patterns, **session_options)
+    results = []
+    nb_run = nb_unchanged = 0
+    try:
+        for idx, test in enumerate(session.get_tests(filename, lines)):
+            key = test[2:]
+            unchanged = idx < len(previous) and previous[idx][0] == key
+            if nb_run == 0 and unchanged:
+                results.append(previous[idx])
+                session.env.update(previous[idx][2])
+                nb_unchanged += 1
+                continue
+            env_before = set(session.env)
+            status = session.run_block(*test)
+            nb_run += 1
+            if status == "failure":
+                break
+            results.append((key, status,
+                            dict((k, session.env[k])
+                                 for k in set(session.env) - env_before)))
+    except ValueError as e:
+        session.echo(e)
+    session.echo("-- %s: %d run, %d unchanged"
+                  % (filename, nb_run, nb_unchanged))
+    return results
+
+
+def watch(filenames, regex_patterns, interval=WATCH_INTERVAL,
+          **session_options):
+    """Run tests of given files again each time one of them changes
+
+    Changes are detected by polling ``get_file_stamp``. Syntax checks
+    results are kept in memory between runs.
+
+    """
+    stamps = {}
+    results = {}
+    while True:
+        for filename in filenames:
+            try:
+                stamp = get_file_stamp(filename)
+            except OSError:
+                continue
+            if stamps.get(filename) == stamp:
+                continue
+            stamps[filename] = stamp
+            results[filename] = watch_run(filename, regex_patterns,
+                                          results.get(filename, []),
+                                          **session_options)
+        time.sleep(interval)
+
+
+##
+## Server mode
+##
+
+class SocketOutput(object):
+    """File like API sending written content as messages on a socket"""
+
+    def __init__(self, sock):
+        self._sock = sock
+
+    def write(self, content):
+        send_message(self._sock, {"out": content})
+
+    def flush(self):
+        pass
+
+
+def send_message(sock, message):
+    import json
+    sock.sendall((json.dumps(message) + "\n").encode("utf-8"))
+
+
+def iter_messages(sock):
+    import json
+    f = sock.makefile("rb")
+    for line in iter(f.readline, b""):
+        yield json.loads(line.decode("utf-8"))
+
+
+def get_cached_tests(documents, filename, regex_patterns):
+    """Returns tests of file, parsing it only if it changed
+
+    ``documents`` holds the parsed files between calls. A parse error
+    is kept and raised again after the tests preceding it are run.
+
+    """
+    key = (filename, tuple(tuple(p) for p in regex_patterns))
+    stamp = get_file_stamp(filename)
+    if key not in documents or documents[key][0] != stamp:
+        tests, error = [], None
+        with open(filename, encoding=_preferred_encoding) as f:
+            try:
+                for test in get_tests(filename, f, regex_patterns):
+                    tests.append(test)
+            except ValueError as e:
+                error = e
+        documents[key] = (stamp, tests, error)
+    _stamp, tests, error = documents[key]
+    for test in tests:
+        yield test
+    if error is not None:
+        raise error
+
+
+def serve_request(conn, documents):
+    try:
+        request = next(iter_messages(conn))
+        out = SocketOutput(conn)
+        try:
+            environ = request["environ"]
+            if not PY3:
+                environ = dict((k.encode("utf-8"), v.encode("utf-8"))
+                               for k, v in environ.items())
+            session = Session(request["regex"], out=out, environ=environ,
+                              cwd=request["cwd"], **request["options"])
+            if session.show_rewrites:
+                tests = session.get_tests(
+                    request["filename"],
+                    open(request["filename"], encoding=_preferred_encoding))
+            else:
+                tests = get_cached_tests(documents, request["filename"],
+                                         request["regex"])
+            success = session.run_tests(tests, request["blocks"])
+        except Exception as e:
+            safe_print("Error: %s\n" % e, out=out)
+            success = False
+        send_message(conn, {"exit": 0 if success else 1})
+    finally:
+        conn.close()
+
+
+def serve(socket_path):
+    """Run tests requested by clients connecting on unix socket
+
+    Each request is served in its own thread. Parsed files and syntax
+    check results are kept in memory between requests. The socket file
+    appears only once the server is ready to accept connections.
+
+    """
+    import signal
+    import socket
+    import threading
+    tmp_path = "%s.%d.tmp" % (socket_path, os.getpid())
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(tmp_path)
+    server.listen(5)
+    os.rename(tmp_path, socket_path)
+    ## ensure ``finally`` clause is run on ``kill``
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    documents = {}
+    try:
+        while True:
+            conn, _addr = server.accept()
+            t = threading.Thread(target=serve_request,
+                                 args=(conn, documents))
+            t.daemon = True
+            t.start()
+    finally:
+        server.close()
+        os.unlink(socket_path)
+
+
+def connect(socket_path, filename, regex_patterns, blocks=None,
+            **session_options):
+    """Send run request to a server, and print its output
+
+    Tests are run in the current directory and environment. Returns
+    the exit code of the request.
+
+    """
+    import socket
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except socket.error as e:
+        sock.close()
+        print("Error: can't connect to server on %r: %s."
+              % (socket_path, e.strerror or e))
+        return 1
+    try:
+        send_message(sock, {
+            "cwd": os.getcwd(),
+            "environ": dict(os.environ),
+            "filename": os.path.abspath(filename),
+            "regex": regex_patterns,
+            "blocks": blocks,
+            "options": session_options,
+        })
+        for message in iter_messages(sock):
+            if "exit" in message:
+                return message["exit"]
+            safe_print(message["out"])
+    finally:
+        sock.close()
+    print("Error: connection closed by server.")
+    return 1
 
 
 def split_quote(s, split_char='/', quote='\\'):
@@ -783,55 +1916,210 @@ def split_quote(s, split_char='/', quote='\\'):
     yield buf
 
 
-def safe_print(content):
+def parse_regex(pattern):
+    """Returns regex and replacement from a ``-r`` option value
+
+        >>> parse_regex('#foo/bar#echo#')
+        ('foo/bar', 'echo')
+        >>> parse_regex('afooabara')  # doctest: +ELLIPSIS
+        Traceback (most recent call last):
+        ...
+        ValueError: regex afooabara should start with a delimiter char, ...
+
+    """
+    if re.match('^[a-zA-Z0-9]$', pattern[0]):
+        raise ValueError("regex %s should start with a delimiter char, "
+                         "not an alphanumerical char." % pattern)
+    parts = tuple(split_quote(pattern, split_char=pattern[0]))
+    if not (parts[0] == parts[-1] == ''):
+        raise ValueError("regex should start and "
+                         "end with a delimiter char.")
+    parts = parts[1:-1]
+    if len(parts) > 2:
+        raise ValueError("Found too many delimiter char.")
+    return parts
+
+
+def safe_print(content, out=None):
     if not PY3:
         if isinstance(content, unicode):
             content = content.encode(_preferred_encoding)
 
-    print(content, end='')
-    sys.stdout.flush()
+    out = out or sys.stdout
+    out.write(content)
+    out.flush()
+
+
+def pop_option_values(args, names):
+    """Remove options ``names`` and their values from ``args``
+
+    Returns values in the order they were given.
+
+        >>> args = ["-r", "a", "doc.rst", "--regex", "b"]
+        >>> pop_option_values(args, ["-r", "--regex"]), args
+        (['a', 'b'], ['doc.rst'])
+        >>> pop_option_values(["doc.rst", "--repeat"], ["--repeat"])
+        Traceback (most recent call last):
+        ...
+        ValueError: option --repeat requires a value.
+
+    """
+    values = []
+    idx = 0
+    while idx < len(args):
+        if args[idx] not in names:
+            idx += 1
+            continue
+        if idx + 1 == len(args):
+            raise ValueError("option %s requires a value." % args[idx])
+        values.append(args[idx + 1])
+        del args[idx:idx + 2]
+    return values
+
+
+def pop_option(args, name):
+    """Remove option ``name`` from ``args``, returns its last value"""
+    values = pop_option_values(args, [name])
+    return values[-1] if values else None
+
+
+def pop_flag(args, name):
+    """Remove flag ``name`` from ``args``, returns if it was given"""
+    found = name in args
+    while name in args:
+        args.remove(name)
+    return found
+
+
+def parse_block(block):
+    if not block.isdigit():
+        raise ValueError("block %r should be a number." % block)
+    return int(block)
+
+
+def parse_socket_options(args):
+    socket_opts = {}
+    for arg in ["--serve", "--connect"]:
+        value = pop_option(args, arg)
+        if value is None:
+            continue
+        import socket
+        if not hasattr(socket, "AF_UNIX"):
+            raise ValueError("%s is not supported on this platform." % arg)
+        socket_opts[arg] = value
+    return socket_opts
+
+
+def parse_session_options(args):
+    """Remove ``Session`` options from ``args``, returns them as a dict"""
+    session_options = {}
+    for arg in ["--merge-streams", "--show-rewrites"]:
+        if pop_flag(args, arg):
+            session_options[arg[2:].replace("-", "_")] = True
+    for arg in ["--repeat", "--concurrency"]:
+        value = pop_option(args, arg)
+        if value is None:
+            continue
+        if not value.isdigit() or int(value) == 0:
+            raise ValueError("%s value %r should be a positive number."
+                             % (arg, value))
+        session_options[arg[2:]] = int(value)
+    session_options.update(parse_scratch_options(args))
+    return session_options
+
+
+def parse_scratch_options(args):
+    scratch_options = {}
+    if pop_flag(args, "--scratch-link"):
+        scratch_options["scratch_link"] = True
+    scratch = pop_option(args, "--scratch")
+    if scratch is not None:
+        if scratch not in ("block", "file"):
+            raise ValueError("--scratch value %r should be "
+                             "'block' or 'file'." % scratch)
+        scratch_options["scratch"] = scratch
+    for arg in ["--scratch-base", "--scratch-template"]:
+        value = pop_option(args, arg)
+        if value is None:
+            continue
+        if not os.path.isdir(value):
+            raise ValueError("%s directory %r not found." % (arg, value))
+        scratch_options[arg[2:].replace("-", "_")] = os.path.abspath(value)
+    return scratch_options
+
+
+def check_filenames(filenames):
+    if len(filenames) == 0:
+        print("Error: please provide a rst filename as argument."
+              " (use '--help' option to get usage info)")
+        exit(1)
+    for filename in filenames:
+        if not os.path.exists(filename):
+            print("Error: file %r not found." % filename)
+            exit(1)
+
+
+def use_syntax_cache(path):
+    """Load syntax checks results from ``path``, and save them on exit"""
+    import atexit
+    get_syntax_cache().load(path)
+    atexit.register(get_syntax_cache().save, path)
+
+
+def serve_main(socket_path):
+    try:
+        serve(socket_path)
+    except KeyboardInterrupt:
+        exit(0)
+
+
+def watch_main(filenames, regex_patterns, **session_options):
+    check_filenames(filenames)
+    try:
+        watch(filenames, regex_patterns=regex_patterns, **session_options)
+    except KeyboardInterrupt:
+        exit(0)
 
 
 def main(args):
-    pattern = None
     if any(arg in args for arg in ["-h", "--help"]):
         print(HELP)
         exit(0)
 
-    patterns = []
-    for arg in ["-r", "--regex"]:
-        while arg in args:
-            idx = args.index(arg)
-            pattern = args[idx + 1]
-            del args[idx + 1]
-            del args[idx]
-            if re.match('^[a-zA-Z0-9]$', pattern[0]):
-                print("Error: regex %s should start with a delimiter char, "
-                      "not an alphanumerical char." % pattern)
-                print(USAGE)
-                exit(1)
-            parts = tuple(split_quote(pattern, split_char=pattern[0]))
-            if not (parts[0] == parts[-1] == ''):
-                print("Error: regex should start and"
-                      "end with a delimiter char.")
-                exit(1)
-            parts = parts[1:-1]
-            if len(parts) > 2:
-                print("Error: Found too many delimiter char.")
-                exit(1)
-            patterns.append(parts)
-
-    if len(args) == 0:
-        print("Error: please provide a rst filename as argument."
-              " (use '--help' option to get usage info)")
+    try:
+        patterns = [parse_regex(pattern) for pattern in
+                    pop_option_values(args, ["-r", "--regex"])]
+    except ValueError as e:
+        print("Error: %s" % e)
+        print(USAGE)
         exit(1)
-    filename = args[0]
-    if not os.path.exists(filename):
-        print("Error: file %r not found." % filename)
+    try:
+        blocks = [parse_block(block) for block in
+                  pop_option_values(args, ["-b", "--block"])]
+        syntax_cache = pop_option(args, "--syntax-cache")
+        socket_opts = parse_socket_options(args)
+        session_options = parse_session_options(args)
+    except ValueError as e:
+        print("Error: %s" % e)
         exit(1)
+
+    if syntax_cache is not None:
+        use_syntax_cache(syntax_cache)
+    if "--serve" in socket_opts:
+        serve_main(socket_opts["--serve"])
+    if pop_flag(args, "--watch"):
+        watch_main(args, patterns, **session_options)
+
+    check_filenames(args[:1])
+    filename = args[0]
+    if "--connect" in socket_opts:
+        exit(connect(socket_opts["--connect"], filename,
+                     regex_patterns=patterns, blocks=blocks,
+                     **session_options))
     shtest_runner(filename,
                   open(filename, encoding=_preferred_encoding),
-                  regex_patterns=patterns)
+                  regex_patterns=patterns, blocks=blocks,
+                  **session_options)
 
 
 def entrypoint():
@@ -0,0 +1,135 @@
+# -*- encoding: utf-8 -*-
+"""pytest plugin collecting each docshtest block as a test item
+
+Collection of ``.rst`` and ``.org`` files is enabled with the
+``--docshtest`` option. Blocks are run in-process with
+``docshtest.run_and_check``.
+
+All blocks of a file are put in the same ``xdist_group``, so that
+``pytest-xdist`` (with ``--dist loadgroup``) runs them in order on the
+same worker. Blocks a test depends on through meta-commands are run
+first if they were not selected (for instance with ``--lf``).
+
+"""
+
+import pytest
+
+import docshtest
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup("docshtest")
+    group.addoption(
+        "--docshtest", action="store_true", default=False,
+        help="collect docshtest blocks from .rst and .org files.")
+    group.addoption(
+        "--docshtest-regex", action="append", default=[], metavar="REGEX",
+        help="regex to apply to the lines to be executed, same as "
+        "docshtest's --regex option. Can be repeated.")
+    group.addoption(
+        "--docshtest-merge-streams", action="store_true", default=False,
+        help="capture standard error of blocks in the same pipe as "
+        "standard output.")
+
+
+def pytest_configure(config):
+    ## declared by ``pytest-xdist``, but it might not be installed
+    config.addinivalue_line(
+        "markers", "xdist_group(name): run tests of the group on the "
+        "same worker.")
+
+
+def pytest_collect_file(parent, file_path):
+    config = parent.config
+    if not config.getoption("docshtest"):
+        return None
+    if file_path.suffix not in (".rst", ".org"):
+        return None
+    return DocshtestFile.from_parent(parent, path=file_path)
+
+
+class DocshtestFailure(Exception):
+    pass
+
+
+class DocshtestFile(pytest.File):
+
+    def collect(self):
+        try:
+            patterns = [docshtest.parse_regex(p) for p in
+                        self.config.getoption("docshtest_regex")]
+        except ValueError as e:
+            raise pytest.UsageError("docshtest: %s" % e)
+        self.env = {}
+        self.statuses = {}
+        with open(str(self.path), encoding=docshtest._preferred_encoding) \
+             as f:
+            self.tests = list(docshtest.get_tests(str(self.path), f,
+                                                  patterns))
+        for test in self.tests:
+            yield DocshtestItem.from_parent(
+                self, name="block-%04d" % test[0], test=test)
+
+    def dependencies(self, test):
+        """Returns previous tests setting variables used by ``test``"""
+        _set_vars, used_vars = docshtest.get_meta_vars(
+            docshtest.get_meta_commands(test[2]))
+        for previous in self.tests[:test[0] - 1]:
+            set_vars, _used_vars = docshtest.get_meta_vars(
+                docshtest.get_meta_commands(previous[2]))
+            if set(set_vars).intersection(used_vars):
+                yield previous
+
+    def run_block(self, test):
+        """Run test once, returns its status and exception"""
+        block_nb = test[0]
+        if block_nb not in self.statuses:
+            for dependency in self.dependencies(test):
+                self.run_block(dependency)
+            try:
+                docshtest.run_and_check(
+                    test[2], test[3], env=self.env,
+                    merge_streams=self.config.getoption(
+                        "docshtest_merge_streams"))
+            except docshtest.UnmatchedLine as e:
+                self.statuses[block_nb] = ("failure", e)
+            except docshtest.InvalidExpectedOutput as e:
+                self.statuses[block_nb] = ("invalid", e)
+            except docshtest.Ignored as e:
+                self.statuses[block_nb] = ("ignored", e)
+            else:
+                self.statuses[block_nb] = ("success", None)
+        return self.statuses[block_nb]
+
+
+class DocshtestItem(pytest.Item):
+
+    def __init__(self, test, **kwargs):
+        super(DocshtestItem, self).__init__(**kwargs)
+        self.test = test
+        self.add_marker(pytest.mark.xdist_group(name=str(self.parent.path)))
+
+    def runtest(self):
+        status, e = self.parent.run_block(self.test)
+        if status == "failure":
+            raise DocshtestFailure(*e.args)
+        if status == "invalid":
+            pytest.fail(e.args[0], pytrace=False)
+        if status == "ignored":
+            pytest.skip("ignored: %s" % " ".join(e.args))
+
+    def repr_failure(self, excinfo):
+        if isinstance(excinfo.value, DocshtestFailure):
+            block_nb, line_range, command, _expected = self.test
+            output, expected = excinfo.value.args
+            return docshtest.format_failed_test(
+                "#%04d - failure (%15s):"
+                % (block_nb, docshtest.format_line_range(*line_range)),
+                command, output, expected)
+        return super(DocshtestItem, self).repr_failure(excinfo)
+
+    def reportinfo(self):
+        block_nb, line_range, _command, _expected = self.test
+        lines = " ".join(docshtest.format_line_range(*line_range).split())
+        return (self.path, line_range[0] - 1,
+                "docshtest block #%04d (%s)" % (block_nb, lines))